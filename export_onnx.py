@@ -0,0 +1,19 @@
+# 将 rf_mods_model.joblib 导出为 rf_mods_model.onnx，供 streamlit_trauma_mods.py 用 ONNX Runtime 预测
+# 每次替换 joblib 模型后需重新运行：python export_onnx.py
+# 依赖 skl2onnx (仅导出时需要，应用运行时不需要)
+import joblib
+import numpy as np
+from skl2onnx import to_onnx
+
+model = joblib.load('rf_mods_model.joblib')
+
+# zipmap=False：输出 'probabilities' 为 (n, 2) 的普通张量，而不是字典列表
+onx = to_onnx(
+    model,
+    np.zeros((1, model.n_features_in_), dtype=np.float32),
+    options={id(model): {"zipmap": False}},
+    target_opset=15
+)
+
+with open('rf_mods_model.onnx', 'wb') as f:
+    f.write(onx.SerializeToString())
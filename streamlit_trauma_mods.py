@@ -1,10 +1,22 @@
 
+import bisect
+import io
+import itertools
+import os
+import warnings
+
 import numpy as np
-import pandas as pd
 import streamlit as st
 import joblib
-import shap
-import matplotlib.pyplot as plt
+
+# shap 与 matplotlib 导入较慢 (约 2 秒)，仅在点击预测后才需要，
+# 因此在使用处延迟导入，首次打开页面时输入控件可立即显示
+
+# 可选依赖：未安装 onnxruntime 时回退到 Numba 打分函数或 sklearn 推理
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
 
 # ==========================================
 # 页面配置与样式
@@ -20,7 +32,7 @@ st.markdown("""
     .main {
         padding: 2rem 3rem;
     }
-    .stButton>button {
+    .stButton>button, .stFormSubmitButton>button {
         width: 100%;
         background-color: #0e4c92;
         color: white;
@@ -43,14 +55,226 @@ st.markdown("""
 def load_model():
     # 确保 'rf_model_new.joblib' 文件在同级目录下
     try:
-        model = joblib.load('rf_mods_model.joblib')
+        # mmap_mode='r'：模型中的 numpy 数组按需从磁盘映射，降低冷启动内存峰值
+        model = joblib.load('rf_mods_model.joblib', mmap_mode='r')
         return model
     except FileNotFoundError:
         st.error("Error: Model file 'rf_model_new.joblib' not found.")
         return None
 
+@st.cache_resource
+def load_onnx_session():
+    # 单行推理优先使用 ONNX Runtime ('rf_mods_model.onnx'，由 skl2onnx 从同一模型导出)
+    # 未安装 onnxruntime 或缺少 onnx 文件时返回 None，回退到 Numba 打分函数或 sklearn 推理
+    # onnx 文件由 export_onnx.py 导出；替换 joblib 模型后若未重新导出，两者会不一致，
+    # 因此先用 BATCH_TEMPLATE 对比两者的预测，差异超过 1e-5 时不使用 onnx
+    model = load_model()
+    if model is None or ort is None or not os.path.exists('rf_mods_model.onnx'):
+        return None
+    session = ort.InferenceSession('rf_mods_model.onnx', providers=["CPUExecutionProvider"])
+    onnx_probs = session.run(["probabilities"], {session.get_inputs()[0].name: BATCH_TEMPLATE})[0]
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="X does not have valid feature names")
+        sklearn_probs = model.predict_proba(BATCH_TEMPLATE)
+    if np.abs(onnx_probs - sklearn_probs).max() > 1e-5:
+        return None
+    return session
+
+@st.cache_resource
+def get_tree_scorer(_model):
+    # 未安装 onnxruntime 时的快速路径：把森林展开为扁平数组 (每个节点的 feature / threshold /
+    # 左右子节点 / 阳性类概率，按树首尾相接)，由 Numba 编译的函数逐树遍历求平均概率，
+    # 跳过 sklearn predict_proba 的输入校验与逐树 Python 调度
+    # numba 不可用时返回 None，使用 sklearn 模型预测
+    try:
+        from numba import njit
+    except ImportError:
+        return None
+
+    feature, threshold, left, right, value, tree_offsets = [], [], [], [], [], [0]
+    for est in _model.estimators_:
+        tree = est.tree_
+        offset = tree_offsets[-1]
+        is_split = tree.children_left != -1
+        # 子节点下标加上本树在扁平数组中的起始位置，叶子保持 -1
+        left.append(np.where(is_split, tree.children_left + offset, -1))
+        right.append(np.where(is_split, tree.children_right + offset, -1))
+        feature.append(tree.feature)
+        threshold.append(tree.threshold)
+        # tree_.value 为各节点的类别计数，归一化后取 index 1 (MODS发生)
+        counts = tree.value[:, 0, :]
+        value.append(counts[:, 1] / counts.sum(axis=1))
+        tree_offsets.append(offset + tree.node_count)
+
+    # 阈值与叶子概率以 float32 存储，树数组占用减半；输入本身即为 float32
+    # 阈值向下取到不大于原值的最近 float32，保证对任意 float32 输入 x <= threshold 的结果不变
+    threshold = np.concatenate(threshold)
+    threshold32 = threshold.astype(np.float32)
+    threshold32 = np.where(
+        threshold32 > threshold, np.nextafter(threshold32, np.float32(-np.inf)), threshold32
+    )
+    arrays = (
+        np.concatenate(feature).astype(np.int32),
+        threshold32,
+        np.concatenate(left).astype(np.int32),
+        np.concatenate(right).astype(np.int32),
+        np.concatenate(value).astype(np.float32),
+        np.asarray(tree_offsets, dtype=np.int32),
+    )
+
+    @njit(fastmath=True)
+    def score(X, feature, threshold, left, right, value, tree_offsets):
+        n_trees = tree_offsets.shape[0] - 1
+        out = np.empty(X.shape[0])
+        for i in range(X.shape[0]):
+            total = 0.0
+            for t in range(n_trees):
+                node = tree_offsets[t]
+                while left[node] != -1:
+                    if X[i, feature[node]] <= threshold[node]:
+                        node = left[node]
+                    else:
+                        node = right[node]
+                total += value[node]
+            out[i] = total / n_trees
+        return out
+
+    def predict(X):
+        return score(X, *arrays)
+
+    # 用一行全零数据预热，JIT 编译在加载时完成，首次点击无需等待
+    predict(np.zeros((1, _model.n_features_in_), dtype=np.float32))
+    return predict
+
+@st.cache_resource
+def get_explainer(_model, use_gpu=True):
+    # TreeExplainer 构建需遍历整个森林，模型不变，故每个进程只构建一次
+    # 参数名以下划线开头，Streamlit 不对模型对象做哈希
+    import shap
+
+    if use_gpu:
+        # 优先使用 GPUTreeShap；未编译 CUDA 扩展时 GPUTree 在首次计算才报错，
+        # 因此先用一行全零数据试算，失败则回退到 CPU
+        try:
+            explainer = shap.explainers.GPUTree(_model)
+            explainer.shap_values(np.zeros((1, _model.n_features_in_), dtype=np.float32))
+            return explainer
+        except (ImportError, RuntimeError):
+            pass
+    return shap.TreeExplainer(_model)
+
+# 离散特征的全部组合：renal (0-4) x invasive_line (0/1) x mechvent (0/1)，共 20 行
+# 行号 = (renal * 2 + invasive_line) * 2 + mechvent
+# 批量输入模板 (20 x 10, float32) 在加载时预先分配并填好离散列，计算时只复制并填入连续值；
+# 各会话在不同线程中运行，因此复制模板而不是共享同一块缓冲区
+BATCH_TEMPLATE = np.zeros((20, 10), dtype=np.float32)
+BATCH_TEMPLATE[:, 6:9] = list(itertools.product(range(5), (0, 1), (0, 1)))
+
+def predict_mods(X):
+    # 对 (n x 10, float32) 输入批量预测 MODS 概率 (index 1)，一次调用完成所有行
+    # 依次使用 ONNX Runtime、Numba 打分函数、sklearn 模型
+    model = load_model()
+    session = load_onnx_session()
+    if session is not None:
+        # 输出 'probabilities' 形如 (n, 2)
+        return session.run(["probabilities"], {session.get_inputs()[0].name: X})[0][:, 1]
+
+    tree_scorer = get_tree_scorer(model)
+    if tree_scorer is not None:
+        return tree_scorer(X)
+
+    # 模型以带列名的 DataFrame 训练，传入 ndarray 时 sklearn 会警告缺少特征名，此处忽略
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="X does not have valid feature names")
+        return model.predict_proba(X)[:, 1]
+
+def sweep(col, values, base_row):
+    # 固定其余输入，仅改变第 col 列，对所有取值一次性向量化预测
+    rows = np.repeat(base_row[None, :], len(values), axis=0)
+    rows[:, col] = values
+    return predict_mods(rows)
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def sofa_sensitivity(inputs):
+    # 其余参数不变时 Total SOFA 各取值下的预测概率，按输入缓存，重复提交时不再计算；
+    # Total SOFA 不可能低于 Renal SOFA 分项，因此从当前 renal 开始取值
+    renal = inputs[6]
+    sofa_values = np.arange(renal, 25)
+    sofa_probs = sweep(9, sofa_values, np.asarray(inputs, dtype=np.float32))
+    return sofa_values, sofa_probs
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def run_discrete_batch(continuous, use_gpu=True):
+    # 以 7 个连续输入值为键，一次性批量计算 20 种离散组合的预测概率与 SHAP 值；
+    # 之后只切换 renal / 侵入性导管 / 机械通气时直接查表
+    platelets, riss, sbp, bun, temp, age, sofa = continuous
+
+    # 构建输入数组，必须严格保持训练时的特征顺序
+    X = BATCH_TEMPLATE.copy()
+    X[:, :6] = (platelets, riss, sbp, bun, temp, age)
+    X[:, 9] = sofa
+
+    model = load_model()
+    probs = predict_mods(X)
+
+    explainer = get_explainer(model, use_gpu)
+    shap_values = explainer.shap_values(X)
+
+    # 处理 binary classification 的 shap_values 输出 (通常是 list[array, array])
+    # 我们取 index 1 (positive class / MODS发生)
+    if isinstance(shap_values, list):
+        shap_vals_target = shap_values[1]
+        base_value = explainer.expected_value[1]
+    else:
+        shap_vals_target = shap_values
+        base_value = explainer.expected_value
+
+    return probs, shap_vals_target, float(base_value)
+
+def run_inference(inputs, use_gpu=True):
+    # 返回单个患者的预测概率、SHAP 值与基准值，结果取自按连续输入缓存的批量计算
+    platelets, riss, sbp, bun, temp, age, renal, invasive_line, mech_vent, sofa = inputs
+    probs, shap_vals, base_value = run_discrete_batch(
+        (platelets, riss, sbp, bun, temp, age, sofa), use_gpu
+    )
+    row = (renal * 2 + invasive_line) * 2 + mech_vent
+    return float(probs[row]), shap_vals[row], base_value
+
 model = load_model()
 
+# ==========================================
+# 侧边栏：解释设置
+# ==========================================
+use_gpu_shap = st.sidebar.toggle(
+    "Use GPU SHAP",
+    value=True,
+    help="Compute SHAP values on a CUDA GPU when available; falls back to CPU otherwise."
+)
+
+# ==========================================
+# 风险分级
+# ==========================================
+# 概率 < 0.05 为低风险，< 0.2 为中风险，其余为高风险
+# 每档依次为 (文字颜色, 风险等级, 卡片背景色)
+RISK_CUTOFFS = [0.05, 0.2]
+RISK_BANDS = [
+    ("green", "Low Risk", "#e6f4ea"),
+    ("#ffa500", "Moderate Risk", "#fff8e1"),  # Orange
+    ("#d93025", "High Risk", "#fce8e6"),      # Red
+]
+
+# 每档的结果卡片 HTML 在加载时生成一次，点击时只需 format 填入概率
+RESULT_CARDS = [
+    f"""
+    <div style="background-color: {bg_color}; padding: 20px; border-radius: 10px; border: 1px solid #ddd; text-align: center; margin-bottom: 20px;">
+        <h3 style="margin:0; color: #555;">Probability of MODS (within 7d)</h3>
+        <h1 style="color: {color}; font-size: 56px; margin: 10px 0; font-weight: bold;">{{}}</h1>
+        <h4 style="color: #333;">Risk Level: <span style="color: {color};">{risk_text}</span></h4>
+    </div>
+    """
+    for color, risk_text, bg_color in RISK_BANDS
+]
+
 # ==========================================
 # 主界面
 # ==========================================
@@ -67,71 +291,62 @@ with col1:
     st.subheader("Patient Parameters")
     st.info("Enter clinical data (First 24h)")
     
-    # 1. Age
-    age = st.number_input("Age (years)", min_value=18, max_value=120, value=50, step=1)
-    
-    # 2. Temperature
-    temp = st.slider("Max Temperature (°C)", 30.0, 45.0, 37.0, step=0.1)
-    
-    # 3. Systolic BP
-    sbp = st.slider("Min Systolic BP (mmHg)", 40, 250, 110)
-    
-    # 4. Platelet Count
-    platelets = st.slider("Min Platelet Count (x10^9/L)", 0, 1000, 200)
-    
-    # 5. BUN
-    bun = st.number_input("Max BUN (mg/dL)", min_value=0.0, max_value=200.0, value=20.0, step=0.1)
-    
-    # 6. RISS (Revised Injury Severity Score)
-    riss = st.slider("RISS Score", 0, 75, 15)
-    
-    # 7. SOFA Score (Total)
-    sofa = st.slider("Total SOFA Score (1st Day)", 0, 24, 5)
-    
-    # 8. Renal SOFA Component (修正部分)
-    # SOFA肾脏分项通常为0-4分
-    renal = st.slider(
-        "Renal SOFA Score (Component)", 
-        min_value=0, 
-        max_value=4, 
-        value=0,
-        help="0: Normal, 1-4: Increasing severity based on Creatinine/Urine output"
-    )
-    
-    # 9. Invasive Line
-    inv_line_input = st.selectbox("Invasive Line Used (1st Day)", ("No", "Yes"))
-    invasive_line = 1 if inv_line_input == "Yes" else 0
-    
-    # 10. Mechanical Ventilation
-    mech_vent_input = st.selectbox("Mechanical Ventilation", ("No", "Yes"))
-    mech_vent = 1 if mech_vent_input == "Yes" else 0
+    # 参数放在 form 中：调整滑块不会触发重跑，点击提交时才整体重跑一次
+    with st.form("patient_params"):
+        # 1. Age
+        age = st.number_input("Age (years)", min_value=18, max_value=120, value=50, step=1)
+        
+        # 2. Temperature
+        temp = st.slider("Max Temperature (°C)", 30.0, 45.0, 37.0, step=0.1)
+        
+        # 3. Systolic BP
+        sbp = st.slider("Min Systolic BP (mmHg)", 40, 250, 110)
+        
+        # 4. Platelet Count
+        platelets = st.slider("Min Platelet Count (x10^9/L)", 0, 1000, 200)
+        
+        # 5. BUN
+        bun = st.number_input("Max BUN (mg/dL)", min_value=0.0, max_value=200.0, value=20.0, step=0.1)
+        
+        # 6. RISS (Revised Injury Severity Score)
+        riss = st.slider("RISS Score", 0, 75, 15)
+        
+        # 7. SOFA Score (Total)
+        sofa = st.slider("Total SOFA Score (1st Day)", 0, 24, 5)
+        
+        # 8. Renal SOFA Component (修正部分)
+        # SOFA肾脏分项通常为0-4分
+        renal = st.slider(
+            "Renal SOFA Score (Component)", 
+            min_value=0, 
+            max_value=4, 
+            value=0,
+            help="0: Normal, 1-4: Increasing severity based on Creatinine/Urine output"
+        )
+        
+        # 9. Invasive Line
+        # 选项本身即模型所需的 0/1 编码，format_func 仅负责显示 No/Yes
+        invasive_line = st.selectbox(
+            "Invasive Line Used (1st Day)", (0, 1), format_func=lambda v: "Yes" if v else "No"
+        )
+        
+        # 10. Mechanical Ventilation
+        mech_vent = st.selectbox(
+            "Mechanical Ventilation", (0, 1), format_func=lambda v: "Yes" if v else "No"
+        )
 
-    st.write("") # Spacer
-    predict_btn = st.button("Predict Probability", key="predict")
+        st.write("") # Spacer
+        predict_btn = st.form_submit_button("Predict Probability")
 
 # ==========================================
 # 右侧：预测结果与解释
 # ==========================================
 with col2:
     if predict_btn and model is not None:
-        # 构建输入数据 DataFrame
         # 必须严格保持训练时的特征顺序：
         # ['platelets_min', 'riss', 'sbp_min', 'bun_max', 'temperature_max', 'admission_age', 'renal', 'invasive_line_1stday', 'mechvent', 'sofa_1stday']
-        
-        features_dict = {
-            'platelets_min': platelets,
-            'riss': riss,
-            'sbp_min': sbp,
-            'bun_max': bun,
-            'temperature_max': temp,
-            'admission_age': age,
-            'renal': renal,          # 这里现在是 0-4 的整数
-            'invasive_line_1stday': invasive_line,
-            'mechvent': mech_vent,
-            'sofa_1stday': sofa
-        }
-        
-        input_data = pd.DataFrame([features_dict])
+        # renal 这里是 0-4 的整数
+        inputs = (platelets, riss, sbp, bun, temp, age, renal, invasive_line, mech_vent, sofa)
         
         # 显示用的特征名映射
         display_names = {
@@ -148,72 +363,82 @@ with col2:
         }
 
         try:
-            # 预测
-            prediction_prob = model.predict_proba(input_data)[0, 1]
+            # 预测 (含 SHAP 解释，按输入缓存)
+            # 与本会话上次提交的参数相同时直接复用上次结果，连 cache_data 的哈希与反序列化也省去
+            inference_key = (inputs, use_gpu_shap)
+            if st.session_state.get("_last_key") == inference_key:
+                prediction_prob, shap_vals_target, base_value = st.session_state["_last_result"]
+            else:
+                prediction_prob, shap_vals_target, base_value = run_inference(inputs, use_gpu_shap)
+                st.session_state["_last_key"] = inference_key
+                st.session_state["_last_result"] = (prediction_prob, shap_vals_target, base_value)
             
             # 显示结果区域
             st.subheader("Prediction Result")
             
-            # 颜色逻辑
-            if prediction_prob < 0.05:
-                color = "green"
-                risk_text = "Low Risk"
-                bg_color = "#e6f4ea"
-            elif prediction_prob < 0.2:
-                color = "#ffa500" # Orange
-                risk_text = "Moderate Risk"
-                bg_color = "#fff8e1"
-            else:
-                color = "#d93025" # Red
-                risk_text = "High Risk"
-                bg_color = "#fce8e6"
-
-            # 结果卡片
-            st.markdown(
-                f"""
-                <div style="background-color: {bg_color}; padding: 20px; border-radius: 10px; border: 1px solid #ddd; text-align: center; margin-bottom: 20px;">
-                    <h3 style="margin:0; color: #555;">Probability of MODS (within 7d)</h3>
-                    <h1 style="color: {color}; font-size: 56px; margin: 10px 0; font-weight: bold;">{prediction_prob:.2%}</h1>
-                    <h4 style="color: #333;">Risk Level: <span style="color: {color};">{risk_text}</span></h4>
-                </div>
-                """, 
-                unsafe_allow_html=True
-            )
+            # 结果卡片：按阈值选取预先生成的 HTML 模板，只需填入概率
+            result_card = RESULT_CARDS[bisect.bisect_right(RISK_CUTOFFS, prediction_prob)]
+            st.markdown(result_card.format(f"{prediction_prob:.2%}"), unsafe_allow_html=True)
             
             # 解释部分
             st.subheader("Why this prediction?")
             st.markdown("The chart below shows how each feature contributed to pushing the risk **higher (red)** or **lower (blue)**.")
 
             with st.spinner("Analyzing model decision..."):
-                # SHAP Explanation
-                explainer = shap.TreeExplainer(model)
-                shap_values = explainer.shap_values(input_data)
-                
-                # 处理 binary classification 的 shap_values 输出 (通常是 list[array, array])
-                # 我们取 index 1 (positive class / MODS发生)
-                if isinstance(shap_values, list):
-                    shap_vals_target = shap_values[1]
-                    base_value = explainer.expected_value[1]
-                else:
-                    shap_vals_target = shap_values
-                    base_value = explainer.expected_value
-
-                # 准备绘图数据
-                # 将列名替换为易读名称
-                input_data_display = input_data.rename(columns=display_names)
-                
-                exp = shap.Explanation(
-                    values=shap_vals_target[0], 
-                    base_values=base_value, 
-                    data=input_data_display.iloc[0],
-                    feature_names=input_data_display.columns
-                )
-                
-                # 绘制 Waterfall Plot
-                fig, ax = plt.subplots(figsize=(10, 5))
-                shap.plots.waterfall(exp, show=False, max_display=10)
-                st.pyplot(fig)
-                plt.close(fig)
+                vals = np.asarray(shap_vals_target, dtype=np.float64)
+
+                # 绘图内容 (输入值、SHAP 值、基准值) 与上次相同时直接复用已渲染的 PNG，跳过重绘
+                plot_key = hash((inputs, vals.tobytes(), base_value))
+                cached_plot = st.session_state.get("shap_png")
+                if cached_plot is None or cached_plot[0] != plot_key:
+                    # 准备绘图数据：按 |SHAP| 升序排列，barh 中影响最大的特征位于最上方
+                    order = np.argsort(np.abs(vals))
+                    labels = np.array([
+                        f"{name} = {value:g}" for name, value in zip(display_names.values(), inputs)
+                    ])
+                    colors = np.where(vals > 0, "#d93025", "#1f77b4")  # 红色升高风险，蓝色降低风险
+                    
+                    # 绘制 SHAP 条形图 (单次 barh，替代 shap.plots.waterfall)
+                    # 复用本会话的 Figure/Axes，避免每次点击重新创建
+                    from matplotlib.figure import Figure
+
+                    if "shap_fig" not in st.session_state:
+                        fig = Figure(figsize=(10, 5))
+                        st.session_state.shap_fig = fig
+                        st.session_state.shap_ax = fig.subplots()
+                    fig = st.session_state.shap_fig
+                    ax = st.session_state.shap_ax
+                    ax.cla()
+                    bars = ax.barh(labels[order], vals[order], color=colors[order])
+                    ax.bar_label(bars, fmt="%+.3f", padding=3, fontsize=9)
+                    ax.axvline(0, color="#999", linewidth=0.8)
+                    ax.margins(x=0.15)
+                    ax.set_xlabel("SHAP value (impact on MODS probability)")
+                    ax.set_title(f"E[f(x)] = {base_value:.3f} → f(x) = {base_value + vals.sum():.3f}")
+                    for side in ("top", "right"):
+                        ax.spines[side].set_visible(False)
+                    fig.tight_layout()
+                    
+                    # 与 st.pyplot 相同的导出参数
+                    buf = io.BytesIO()
+                    fig.savefig(buf, format="png", bbox_inches="tight", dpi=200)
+                    cached_plot = (plot_key, buf.getvalue())
+                    st.session_state.shap_png = cached_plot
+
+                st.image(cached_plot[1], use_column_width=True)
+
+            # 敏感性分析：其余参数不变，SOFA 取 renal-24 时的预测概率
+            # 单独捕获异常，图表失败时不影响上方已显示的预测结果
+            with st.expander("Sensitivity to SOFA"):
+                try:
+                    sofa_values, sofa_probs = sofa_sensitivity(inputs)
+                    st.line_chart(
+                        {"Total SOFA": sofa_values, "Probability of MODS": sofa_probs},
+                        x="Total SOFA",
+                        y="Probability of MODS"
+                    )
+                except Exception as e:
+                    st.error(f"Sensitivity Analysis Error: {e}")
 
         except Exception as e:
             st.error(f"Prediction Error: {e}")
@@ -231,3 +456,16 @@ st.warning("""
 It uses a Random Forest model to estimate the risk of MODS based on first-24h data. 
 Results should not replace clinical judgment.
 """)
+
+# ==========================================
+# 预热
+# ==========================================
+# 页面元素全部渲染后，再用当前表单参数跑一遍批量推理：
+# 提前完成 shap 导入、explainer 构建、Numba JIT 编译等冷启动开销，
+# 同时缓存当前参数的结果，用户首次点击预测时无需等待
+# 预热失败不影响页面，点击预测时会按正常流程计算并显示错误
+if model is not None and not predict_btn:
+    try:
+        run_discrete_batch((platelets, riss, sbp, bun, temp, age, sofa), use_gpu_shap)
+    except Exception:
+        pass